@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 """Convert AI detector models to ONNX for transformers.js WebGPU delivery."""
 
+import importlib.util
+import multiprocessing
 import subprocess
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Models to convert (source_repo, output_name)
 MODELS = [
@@ -21,6 +24,10 @@ EXISTING_ONNX = [
 
 OUTPUT_DIR = "/home/zack/dev/observatory/models"
 
+# Opset 17 gets a fused LayerNormalization op (single SIMD kernel) instead of
+# the 7-node subgraph opset 14 emits; supported by the vendored ORT 1.17.0
+OPSET = 17
+
 def install_deps():
     """Install required dependencies."""
     print("Installing dependencies...")
@@ -30,38 +37,153 @@ def install_deps():
         "transformers",
         "torch",
         "Pillow",
+        "onnxconverter-common",
+        "hf_transfer",
         "--user", "-q"
     ], check=True)
     print("✓ Dependencies installed\n")
 
-def convert_model(source_repo, output_name):
+def detect_device():
+    """Pick the export device: CUDA traces 5-10x faster when available."""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return "cuda"
+    except ImportError:
+        pass
+    return "cpu"
+
+def externalize_weights(output_path):
+    """
+    Consolidate an external-data export into one mmap-friendly sidecar.
+
+    The exporter splits weights into external data on its own once an
+    export exceeds protobuf's 2GB limit, but can scatter them across one
+    file per tensor; a single model.onnx.data lets onnx/ORT mmap the
+    weights so parallel quantization workers share one page-cached copy.
+    A single-file export is necessarily under the limit and is left
+    alone - the vendored transformers.js can only fetch a self-contained
+    model.onnx.
+    """
+    model_file = os.path.join(output_path, "model.onnx")
+
+    import onnx
+
+    model = onnx.load(model_file, load_external_data=False)
+    locations = {
+        entry.value
+        for init in model.graph.initializer
+        if init.data_location == onnx.TensorProto.EXTERNAL
+        for entry in init.external_data
+        if entry.key == "location"
+    }
+    if not locations or locations == {"model.onnx.data"}:
+        return
+
+    print(f"Consolidating {len(locations)} weight files: {model_file}")
+    model = onnx.load(model_file)  # pull the scattered external data back in
+    onnx.save(
+        model,
+        model_file,
+        save_as_external_data=True,
+        all_tensors_to_one_file=True,
+        location="model.onnx.data",
+        size_threshold=1024,
+        convert_attribute=False
+    )
+    for location in locations - {"model.onnx.data"}:
+        try:
+            os.unlink(os.path.join(output_path, location))
+        except FileNotFoundError:
+            pass
+
+def convert_model(source_repo, output_name, device="cpu"):
     """Convert a single model to ONNX."""
     print(f"\n{'='*60}")
     print(f"Converting: {source_repo}")
-    print(f"Output: {output_name}")
+    print(f"Output: {output_name} (device: {device})")
     print('='*60)
 
     output_path = os.path.join(OUTPUT_DIR, output_name, "onnx")
 
-    # Export to ONNX with opset 14 (compatible with transformers.js)
+    # One metadata call tells us whether the upstream repo moved since the
+    # last export; if not, skip the multi-GB download + re-export entirely
+    sha_file = os.path.join(OUTPUT_DIR, output_name, ".source_sha")
+    current_sha = None
+    try:
+        from huggingface_hub import HfApi
+        current_sha = HfApi().model_info(source_repo).sha
+    except Exception as e:
+        print(f"⚠ Could not check upstream revision for {source_repo}: {e}")
+
+    # Both emitted artifacts must exist to skip: the FP16 step is non-fatal,
+    # so a past run may have recorded the sha with model_fp16.onnx missing
+    if current_sha and all(
+        os.path.exists(os.path.join(output_path, name))
+        for name in ("model.onnx", "model_fp16.onnx")
+    ):
+        try:
+            with open(sha_file) as f:
+                if f.read().strip() == current_sha:
+                    print(f"⊙ Up to date (revision {current_sha[:12]}), skipping")
+                    return True
+        except FileNotFoundError:
+            pass
+
+    # Imported here rather than at module level so install_deps() can run first
+    from optimum.exporters.onnx import onnx_export_from_model
+    from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+    # Export to ONNX (opset per module constant, compatible with transformers.js)
+    # Loading the model ourselves and fixing the task skips optimum's
+    # task-inference step and the transformers.pipelines import it drags in
     print(f"\n[1/2] Exporting to ONNX...")
-    result = subprocess.run([
-        sys.executable, "-m", "optimum.exporters.onnx",
-        "--model", source_repo,
-        "--task", "image-classification",
-        "--opset", "14",
-        output_path
-    ])
-
-    if result.returncode != 0:
-        print(f"❌ Failed to export {source_repo}")
+    try:
+        model = AutoModelForImageClassification.from_pretrained(source_repo)
+        preprocessor = AutoImageProcessor.from_pretrained(source_repo)
+        onnx_export_from_model(
+            model,
+            output=output_path,
+            task="image-classification",
+            opset=OPSET,
+            device=device,
+            preprocessors=[preprocessor]
+        )
+    except Exception as e:
+        print(f"❌ Failed to export {source_repo}: {e}")
         return False
 
     print(f"✓ ONNX export complete: {output_path}")
 
+    externalize_weights(output_path)
+
+    # FP16 tier: half the download size of FP32 and native on WebGPU,
+    # unlike INT8 which WebGPU only emulates
+    print(f"\n[2/2] Converting to FP16...")
+    try:
+        import onnx
+        from onnxconverter_common.float16 import convert_float_to_float16
+
+        fp16_path = os.path.join(output_path, "model_fp16.onnx")
+        fp16_model = convert_float_to_float16(
+            onnx.load(os.path.join(output_path, "model.onnx")),
+            keep_io_types=True,
+            # Keep numerically sensitive ops in FP32
+            op_block_list=["LayerNormalization", "Erf"]
+        )
+        onnx.save(fp16_model, fp16_path)
+        print(f"✓ FP16 model: {fp16_path}")
+    except Exception as e:
+        print(f"⚠ FP16 conversion failed for {source_repo}: {e}")
+
     # Note: Skipping quantization for now - transformers.js has issues with quantized models
     # Can add back later with: optimum-cli onnxruntime quantize
 
+    # Remember which upstream revision this export came from
+    if current_sha:
+        with open(sha_file, "w") as f:
+            f.write(current_sha + "\n")
+
     return True
 
 def main():
@@ -79,15 +201,37 @@ def main():
     success_count = 0
     fail_count = 0
 
-    for source_repo, output_name in MODELS:
-        try:
-            if convert_model(source_repo, output_name):
-                success_count += 1
-            else:
+    # Parallel HF Hub downloads via the Rust transfer backend; only enable
+    # when the package is importable, since huggingface_hub raises if the
+    # flag is set without it
+    if importlib.util.find_spec("hf_transfer") is not None:
+        os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+    device = detect_device()
+    print(f"Export device: {device}\n")
+
+    # Convert all models concurrently. Exports now run in-process, so use
+    # worker processes: each gets its own torch state and full GIL. Spawn
+    # (not fork) is required: detect_device() initializes CUDA in this
+    # process, and CUDA cannot be re-initialized in a forked child.
+    with ProcessPoolExecutor(
+        max_workers=min(len(MODELS), os.cpu_count()),
+        mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(convert_model, source_repo, output_name, device): source_repo
+            for source_repo, output_name in MODELS
+        }
+        for future in as_completed(futures):
+            source_repo = futures[future]
+            try:
+                if future.result():
+                    success_count += 1
+                else:
+                    fail_count += 1
+            except Exception as e:
+                print(f"❌ Failed to convert {source_repo}: {e}")
                 fail_count += 1
-        except Exception as e:
-            print(f"❌ Failed to convert {source_repo}: {e}")
-            fail_count += 1
 
     print("\n" + "="*60)
     print("Conversion Summary")
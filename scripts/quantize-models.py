@@ -3,7 +3,9 @@
 Model Quantization Script - Convert FP32 ONNX models to INT8
 
 Reduces model sizes by ~75% (164MB -> ~41MB) with minimal accuracy loss.
-Uses ONNX Runtime's dynamic quantization which works well for vision models.
+Uses ONNX Runtime's static quantization: activation ranges are calibrated
+from real images so the graph uses the fast QLinearConv/QLinearMatMul
+kernels instead of recomputing ranges on every inference.
 
 Usage:
     python scripts/quantize-models.py                    # Quantize all models
@@ -11,18 +13,31 @@ Usage:
     python scripts/quantize-models.py --verify          # Verify quantized models
 
 Requirements:
-    pip install onnx onnxruntime
+    pip install onnx onnxruntime Pillow
 """
 
 import os
 import sys
 import argparse
+import hashlib
+import json
+import mmap
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 try:
+    import numpy as np
     import onnx
-    from onnxruntime.quantization import quantize_dynamic, QuantType
-    from onnxruntime.quantization.shape_inference import quant_pre_process
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+    from onnxruntime.tools.symbolic_shape_infer import SymbolicShapeInference
 except ImportError:
     print("Error: Required packages not installed.")
     print("Run: pip install onnx onnxruntime")
@@ -32,6 +47,26 @@ except ImportError:
 # Model directories relative to project root
 MODELS_DIR = Path(__file__).parent.parent / "models"
 
+# Default calibration images (bundled test set, same distribution as production)
+CALIBRATION_DIR = Path(__file__).parent.parent / "test_images"
+
+# Cap on calibration samples - diminishing returns beyond ~100 images
+MAX_CALIBRATION_SAMPLES = 100
+
+# Image types accepted as calibration input
+CALIBRATION_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+# Only quantize the compute-heavy ops; everything else stays FP32
+OP_TYPES_TO_QUANTIZE = ["Conv", "MatMul", "Gemm"]
+
+# Nodes found to be quantization-sensitive (per-model "model/node" entries
+# discovered by accuracy comparison against the FP32 output)
+NODES_TO_EXCLUDE: list[str] = []
+
+# Single-threaded inference budget for --verify; a quantized model blowing
+# past this has hit an unoptimized kernel path
+VERIFY_LATENCY_BUDGET_MS = 500
+
 # Models to quantize
 MODELS = [
     "dima806_ai_real",
@@ -56,66 +91,292 @@ def get_model_paths(model_name: str) -> tuple[Path, Path]:
 
 
 def get_model_size(path: Path) -> float:
-    """Get model size in MB."""
-    if path.exists():
+    """Get model size in MB (0 if missing). Single stat(), no exists() probe."""
+    try:
         return path.stat().st_size / (1024 * 1024)
-    return 0
+    except FileNotFoundError:
+        return 0
+
+
+def has_dot_product_isa() -> bool:
+    """
+    True if the CPU has int8 dot-product instructions (x86 VNNI or Arm
+    DotProd). Without them, u8s8 GEMM accumulates in int16 and can
+    saturate, so pre-VNNI CPUs need reduce_range=True (7-bit weights).
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+        return any(f in flags for f in ("avx512_vnni", "avx_vnni", "asimddp"))
+    except OSError:
+        # No /proc (macOS, Windows): assume modern hardware
+        return True
+
+
+def model_uses_external_data(model_path: Path) -> bool:
+    """True if the model stores weights in an external-data sidecar."""
+    model = onnx.load(str(model_path), load_external_data=False)
+    return any(
+        init.data_location == onnx.TensorProto.EXTERNAL
+        for init in model.graph.initializer
+    )
+
+
+def hash_file(path: Path) -> str:
+    """BLAKE2b content hash without a whole-file userspace allocation."""
+    with open(path, "rb") as f:
+        try:
+            # Python 3.11+: releases the GIL and chunks internally
+            return hashlib.file_digest(f, "blake2b").hexdigest()
+        except AttributeError:
+            # Python 3.10: hash straight out of the page cache via mmap
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.blake2b(mm).hexdigest()
+
+
+def calibration_fingerprint(calibration_dir: Path) -> str:
+    """
+    Hash of the calibration image names and contents. Part of the skip-cache
+    key: calibration data determines the quantized activation ranges, so
+    changing it must invalidate existing outputs.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for path in sorted(calibration_dir.iterdir()):
+        if path.suffix.lower() in CALIBRATION_EXTS:
+            h.update(path.name.encode())
+            h.update(bytes.fromhex(hash_file(path)))
+    return h.hexdigest()
+
+
+class ImageCalibrationDataReader(CalibrationDataReader):
+    """
+    Feeds preprocessed images to the static quantizer for calibration.
+
+    Resize and normalization parameters come from the model's own
+    preprocessor_config.json (the checked-in models disagree: some use
+    0.5/0.5 mean/std, some ImageNet stats), so calibration sees the same
+    input distribution the model was trained on. FP32 NCHW batches of 1.
+    """
 
+    # Fallbacks when no preprocessor_config.json is found; most of the
+    # checked-in models normalize with 0.5/0.5
+    DEFAULT_MEAN = [0.5, 0.5, 0.5]
+    DEFAULT_STD = [0.5, 0.5, 0.5]
+    DEFAULT_SIZE = 224
 
-def quantize_model(model_name: str, force: bool = False) -> bool:
+    def __init__(self, model_path: Path, calibration_dir: Path):
+        try:
+            from PIL import Image
+        except ImportError:
+            print("Error: Pillow is required for calibration.")
+            print("Run: pip install Pillow")
+            sys.exit(1)
+
+        model = onnx.load(str(model_path), load_external_data=False)
+        self.input_name = model.graph.input[0].name
+
+        mean, std, self.size = self._load_preprocessor_config(model_path)
+        self.mean = np.array(mean, dtype=np.float32)
+        self.std = np.array(std, dtype=np.float32)
+
+        image_paths = sorted(
+            p for p in calibration_dir.iterdir()
+            if p.suffix.lower() in CALIBRATION_EXTS
+        )[:MAX_CALIBRATION_SAMPLES]
+
+        if not image_paths:
+            raise RuntimeError(f"No calibration images found in {calibration_dir}")
+
+        self.samples = [self._preprocess(Image.open(p)) for p in image_paths]
+        self.index = 0
+
+    def _load_preprocessor_config(self, model_path: Path):
+        """Read image_mean/image_std/size from the model's preprocessor config."""
+        # The model lives either in the model dir or its onnx/ subdirectory;
+        # preprocessor_config.json sits in the model dir
+        for candidate in (model_path.parent, model_path.parent.parent):
+            config_path = candidate / "preprocessor_config.json"
+            if config_path.exists():
+                config = json.loads(config_path.read_text())
+                size = config.get("size", self.DEFAULT_SIZE)
+                if isinstance(size, dict):
+                    size = size.get("height") or size.get("shortest_edge") \
+                        or self.DEFAULT_SIZE
+                return (config.get("image_mean", self.DEFAULT_MEAN),
+                        config.get("image_std", self.DEFAULT_STD),
+                        size)
+
+        print(f"  [WARN] No preprocessor_config.json near {model_path}, "
+              f"using defaults")
+        return self.DEFAULT_MEAN, self.DEFAULT_STD, self.DEFAULT_SIZE
+
+    def _preprocess(self, image) -> np.ndarray:
+        image = image.convert("RGB").resize((self.size, self.size))
+        pixels = np.asarray(image, dtype=np.float32) / 255.0
+        pixels = (pixels - self.mean) / self.std
+        # HWC -> NCHW
+        return pixels.transpose(2, 0, 1)[np.newaxis, ...]
+
+    def get_next(self):
+        if self.index >= len(self.samples):
+            return None
+        sample = {self.input_name: self.samples[self.index]}
+        self.index += 1
+        return sample
+
+    def rewind(self):
+        self.index = 0
+
+
+def quantize_model(model_name: str, force: bool = False,
+                   calibration_dir: Path = CALIBRATION_DIR,
+                   weight_type: QuantType = QuantType.QInt8) -> bool:
     """
     Quantize a single model from FP32 to INT8.
 
     Args:
         model_name: Name of the model directory
         force: Overwrite existing quantized model
+        calibration_dir: Directory of images used to calibrate activation ranges
+        weight_type: Weight quantization type (QInt8 hits the VNNI/SDOT kernels)
 
     Returns:
         True if successful, False otherwise
     """
+    print(f"\n[{model_name}]")
     input_path, output_path = get_model_paths(model_name)
 
     if not input_path.exists():
         print(f"  [ERROR] Model not found: {input_path}")
         return False
 
-    if output_path.exists() and not force:
-        print(f"  [SKIP] Already quantized: {output_path}")
-        return True
+    # Skip-cache: if the input hash and quantization config match what
+    # produced the existing output, there is nothing to redo - even --force
+    # only regenerates models whose inputs actually changed
+    reduce_range = not has_dot_product_isa()
+    if reduce_range:
+        print(f"  [INFO] No VNNI/DotProd support, using 7-bit weight range")
+
+    cache_path = output_path.with_suffix(".onnx.sha")
+    cache_entry = {
+        "input_sha": hash_file(input_path),
+        "config": {
+            "weight_type": weight_type.name,
+            "activation_type": QuantType.QInt8.name,
+            "quant_format": "QDQ",
+            "per_channel": True,
+            "reduce_range": reduce_range,
+            "calibration": calibration_fingerprint(calibration_dir),
+        },
+    }
+    if output_path.exists():
+        try:
+            if json.loads(cache_path.read_text()) == cache_entry:
+                print(f"  [SKIP] Input and config unchanged: {output_path}")
+                return True
+        except (OSError, json.JSONDecodeError):
+            pass
+        if not force:
+            print(f"  [SKIP] Already quantized: {output_path}")
+            return True
 
     input_size = get_model_size(input_path)
     print(f"  [INFO] Input: {input_path} ({input_size:.1f}MB)")
 
     try:
-        # Preprocess model for quantization (shape inference)
-        print(f"  [STEP] Preprocessing model...")
+        # Follow the input's own layout: a single-file model is necessarily
+        # under protobuf's 2GB limit, and anything larger already references
+        # an external-data sidecar (the .onnx itself stays small), so the
+        # file size says nothing about which path to take
+        use_external_data = model_uses_external_data(input_path)
+        if use_external_data:
+            print(f"  [INFO] Model uses external data, keeping that format")
+
+        # Symbolic shape inference only; quant_pre_process's extra optimizer
+        # and opset-update passes are redundant for models freshly exported
+        # by optimum at a known opset
+        print(f"  [STEP] Preprocessing model (shape inference)...")
         preprocessed_path = input_path.parent / "model_preprocessed.onnx"
 
         try:
-            quant_pre_process(
-                str(input_path),
+            inferred = SymbolicShapeInference.infer_shapes(
+                onnx.load(str(input_path)),
+                auto_merge=True,
+                int_max=100_000
+            )
+            # Explicit location: onnx.save would otherwise pick a random
+            # (uuid) sidecar name that the cleanup below wouldn't find
+            onnx.save(
+                inferred,
                 str(preprocessed_path),
-                skip_symbolic_shape=True
+                save_as_external_data=use_external_data,
+                all_tensors_to_one_file=True,
+                location=preprocessed_path.name + ".data"
             )
             quantize_input = preprocessed_path
+        except AttributeError:
+            # A missing API is a bug in this script, not a model problem
+            raise
         except Exception as e:
             print(f"  [WARN] Preprocessing failed ({e}), using original model")
             quantize_input = input_path
 
-        # Quantize to INT8 using dynamic quantization
+        # Calibrate activation ranges from real images
+        print(f"  [STEP] Calibrating from {calibration_dir}...")
+        reader = ImageCalibrationDataReader(quantize_input, calibration_dir)
+
+        # Quantize to INT8 using static quantization
         print(f"  [STEP] Quantizing to INT8...")
-        quantize_dynamic(
+        quantize_static(
             model_input=str(quantize_input),
             model_output=str(output_path),
-            weight_type=QuantType.QUInt8,
-            optimize_model=True,
-            per_channel=False,  # per_channel can cause issues with some ops
-            reduce_range=False
+            calibration_data_reader=reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QInt8,
+            weight_type=weight_type,
+            calibrate_method=CalibrationMethod.MinMax,
+            use_external_data_format=use_external_data,
+            per_channel=True,  # per-channel scales preserve Conv accuracy
+            reduce_range=reduce_range,
+            op_types_to_quantize=OP_TYPES_TO_QUANTIZE,
+            nodes_to_exclude=NODES_TO_EXCLUDE,
+            extra_options={
+                # Avoid the MatMulIntegerToFloat 3D-weight path that used
+                # to crash per-channel quantization
+                "MatMulConstBOnly": True,
+                "EnableSubgraph": False,
+                "ForceQuantizeNoInputCheck": False,
+                # Symmetric weights (zero-point 0) are what the VNNI/SDOT
+                # dot-product kernels expect
+                "ActivationSymmetric": False,
+                "WeightSymmetric": True,
+            }
         )
 
-        # Clean up preprocessed model
-        if preprocessed_path.exists():
-            preprocessed_path.unlink()
+        # Clean up preprocessed model (and external-data sidecar if any)
+        preprocessed_path.unlink(missing_ok=True)
+        preprocessed_path.with_suffix(".onnx.data").unlink(missing_ok=True)
+
+        # Bake in Level 99 graph optimizations (constant folding, Q-node
+        # fusion) so sessions don't re-run them on every load
+        print(f"  [STEP] Saving pre-optimized .ort...")
+        try:
+            import onnxruntime as ort
+
+            so = ort.SessionOptions()
+            so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            so.optimized_model_filepath = str(output_path.with_suffix(".ort"))
+            ort.InferenceSession(
+                str(output_path),
+                sess_options=so,
+                providers=['CPUExecutionProvider']
+            )
+            print(f"  [OK] Optimized model: {output_path.with_suffix('.ort')}")
+        except Exception as e:
+            print(f"  [WARN] Could not save optimized model: {e}")
+
+        # Record what produced this output so later runs can skip it
+        cache_path.write_text(json.dumps(cache_entry, indent=2))
 
         output_size = get_model_size(output_path)
         reduction = ((input_size - output_size) / input_size) * 100
@@ -127,11 +388,14 @@ def quantize_model(model_name: str, force: bool = False) -> bool:
         onnx_dir = input_path.parent / "onnx" if "onnx" not in str(input_path) else input_path.parent
         if onnx_dir.exists():
             quantized_link = onnx_dir / "model_quantized.onnx"
-            if quantized_link.is_symlink():
-                quantized_link.unlink()
-            # Create relative symlink
             rel_path = os.path.relpath(output_path, onnx_dir)
-            quantized_link.symlink_to(rel_path)
+            # Build the new link aside and swap it in atomically, so neither
+            # a crash mid-update nor a parallel worker in the same directory
+            # can leave the app without a model_quantized.onnx to load
+            tmp_link = quantized_link.with_suffix(".onnx.tmp")
+            tmp_link.unlink(missing_ok=True)
+            os.symlink(rel_path, tmp_link)
+            os.replace(tmp_link, quantized_link)
             print(f"  [OK] Updated symlink: {quantized_link} -> {rel_path}")
 
         return True
@@ -143,8 +407,39 @@ def quantize_model(model_name: str, force: bool = False) -> bool:
         return False
 
 
+def write_manifest(models: list[str]) -> None:
+    """
+    Write models/manifest.json listing each model's variants (sizes in MB,
+    0 = variant missing) so the client picks one in a single fetch instead
+    of probing every models/*/onnx/ directory with HEAD requests.
+    """
+    manifest = {}
+    for model in models:
+        input_path, output_path = get_model_paths(model)
+        entry = {
+            "fp32": round(get_model_size(input_path), 1),
+            "fp16": round(get_model_size(input_path.parent / "model_fp16.onnx"), 1),
+            "int8": round(get_model_size(output_path), 1),
+        }
+        try:
+            cache = json.loads(output_path.with_suffix(".onnx.sha").read_text())
+            entry["sha"] = cache["input_sha"]
+        except (OSError, json.JSONDecodeError, KeyError):
+            pass
+        manifest[model] = entry
+
+    manifest_path = MODELS_DIR / "manifest.json"
+    manifest_path.write_text(json.dumps(manifest, indent=2) + "\n")
+    print(f"\nWrote manifest: {manifest_path}")
+
+
+def _init_quantize_worker():
+    """Pin each worker to one thread - parallelism comes from the pool."""
+    os.environ["OMP_NUM_THREADS"] = "1"
+
+
 def verify_model(model_name: str) -> bool:
-    """Verify a quantized model can be loaded."""
+    """Verify a quantized model loads and infers quickly on a single thread."""
     _, output_path = get_model_paths(model_name)
 
     if not output_path.exists():
@@ -154,10 +449,18 @@ def verify_model(model_name: str) -> bool:
     try:
         import onnxruntime as ort
 
-        # Try to create inference session
+        # Pin to one thread: the app loads several models at once, and the
+        # default num_physical_cores threads per session hides models that
+        # are only fast because ORT grabbed every core
+        so = ort.SessionOptions()
+        so.intra_op_num_threads = 1
+        so.inter_op_num_threads = 1
+        so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+
         print(f"  [STEP] Loading {output_path}...")
         session = ort.InferenceSession(
             str(output_path),
+            sess_options=so,
             providers=['CPUExecutionProvider']
         )
 
@@ -169,6 +472,21 @@ def verify_model(model_name: str) -> bool:
         print(f"  [INFO] Inputs: {[i.name + ' ' + str(i.shape) for i in inputs]}")
         print(f"  [INFO] Outputs: {[o.name for o in outputs]}")
 
+        # Timed smoke inference on a dummy input (dynamic dims -> 1)
+        spec = inputs[0]
+        shape = [dim if isinstance(dim, int) else 1 for dim in spec.shape]
+        dummy = np.zeros(shape, dtype=np.float32)
+
+        start = time.perf_counter()
+        session.run(None, {spec.name: dummy})
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        print(f"  [INFO] Single-thread inference: {elapsed_ms:.0f}ms")
+        if elapsed_ms > VERIFY_LATENCY_BUDGET_MS:
+            print(f"  [ERROR] Exceeded {VERIFY_LATENCY_BUDGET_MS}ms budget - "
+                  f"likely an unoptimized kernel or thread-config regression")
+            return False
+
         return True
 
     except Exception as e:
@@ -201,6 +519,18 @@ def main():
         action="store_true",
         help="List available models and their sizes"
     )
+    parser.add_argument(
+        "--weight-type",
+        choices=["qint8", "quint8"],
+        default="qint8",
+        help="Weight quantization type (qint8 enables VNNI/SDOT fast paths)"
+    )
+    parser.add_argument(
+        "--calibration-dir",
+        type=Path,
+        default=CALIBRATION_DIR,
+        help="Directory of images for calibration (default: bundled test_images)"
+    )
 
     args = parser.parse_args()
 
@@ -220,7 +550,7 @@ def main():
             total_fp32 += fp32_size
             total_int8 += int8_size
 
-            status = "quantized" if output_path.exists() else "not quantized"
+            status = "quantized" if int8_size > 0 else "not quantized"
             print(f"  {model}: {fp32_size:.1f}MB FP32, {int8_size:.1f}MB INT8 ({status})")
 
         print(f"\nTotal FP32: {total_fp32:.1f}MB")
@@ -240,14 +570,30 @@ def main():
         print(f"\n{success}/{len(args.models)} models verified successfully")
         return
 
-    # Quantize models
+    # Fail fast on a missing/mistyped calibration dir; inside a worker it
+    # would abort the whole pool instead of degrading per-model
+    if not args.calibration_dir.is_dir():
+        print(f"\nError: calibration directory not found: {args.calibration_dir}")
+        sys.exit(1)
+
+    # Quantize models in parallel - each quantization is single-threaded
+    # CPU work, so one worker per model up to the core count
+    weight_type = QuantType.QInt8 if args.weight_type == "qint8" else QuantType.QUInt8
     print(f"\nQuantizing {len(args.models)} models...")
-    success = 0
 
-    for model in args.models:
-        print(f"\n[{model}]")
-        if quantize_model(model, force=args.force):
-            success += 1
+    worker = partial(quantize_model, force=args.force,
+                     calibration_dir=args.calibration_dir,
+                     weight_type=weight_type)
+    with ProcessPoolExecutor(
+        max_workers=min(len(args.models), os.cpu_count()),
+        initializer=_init_quantize_worker
+    ) as executor:
+        results = list(executor.map(worker, args.models))
+    success = sum(results)
+
+    # Always rebuild the manifest over the full model list - quantizing a
+    # subset must not drop the other models' entries
+    write_manifest(sorted(set(MODELS) | set(args.models)))
 
     print("\n" + "=" * 60)
     print(f"Quantization complete: {success}/{len(args.models)} successful")